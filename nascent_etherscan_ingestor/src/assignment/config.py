@@ -9,14 +9,31 @@ RECORD_RETRIEVAL_LIMIT = int(CONFIG["RECORD_RETRIEVAL_LIMIT"])
 API_KEY = CONFIG["API_KEY"]
 PRODUCER_THREAD_COUNT = int(CONFIG.get("PRODUCER_THREAD_COUNT", 4))
 CONSUMER_THREAD_COUNT = int(CONFIG.get("CONSUMER_THREAD_COUNT", 2))
+# each consumer queue holds lists of at most SAVE_BATCH_LIMIT transactions, so it buffers up to
+# TRANSACTION_QUEUE_SIZE * SAVE_BATCH_LIMIT rows
+TRANSACTION_QUEUE_SIZE = int(CONFIG.get("TRANSACTION_QUEUE_SIZE", 4))
+ADDRESS_CACHE_SIZE = int(CONFIG.get("ADDRESS_CACHE_SIZE", 100_000))
 SEMAPHOR_THREAD_COUNT = int(CONFIG.get("SEMAPHOR_THREAD_COUNT", 10))
 DEFAULT_ADDRESS = CONFIG.get("DEFAULT_ADDRESS", "default_ethereum_address")
 DEV_MODE = CONFIG.get('DEV_MODE')
 DEV_MODE_ENDING_MULTIPLE = int(CONFIG.get("DEV_MODE_ENDING_MULTIPLE"))
 DEV_STEP = int(CONFIG.get("DEV_STEP"))
 DEV_PRODUCER_THREAD_COUNT = int(CONFIG.get("DEV_PRODUCER_THREAD_COUNT"))
-API_RATE_LIMIT_DELAY = float(CONFIG.get("API_RATE_LIMIT_DELAY"))
-SAVE_BATCH_LIMIT = int(CONFIG.get("SAVE_BATCH_LIMIT"))
+API_RATE_LIMIT = int(CONFIG.get("API_RATE_LIMIT", 5))
+API_RATE_LIMIT_PERIOD = float(CONFIG.get("API_RATE_LIMIT_PERIOD", 1.0))
+HTTP_TIMEOUT = float(CONFIG.get("HTTP_TIMEOUT", 10))
+HTTP_KEEPALIVE_TIMEOUT = float(CONFIG.get("HTTP_KEEPALIVE_TIMEOUT", 30))
+ETHERSCAN_BATCH_SIZE = int(CONFIG.get("ETHERSCAN_BATCH_SIZE", 10))
+# rows per consumer INSERT, also used as psycopg2's VALUES page size (see db.py) so a batch is a single statement.
+# 10k is the postgres sweet spot; dialects with a bind parameter cap need SAVE_BATCH_LIMIT * 9 columns under it.
+SAVE_BATCH_LIMIT = int(CONFIG.get("SAVE_BATCH_LIMIT", 10_000))
+# batches at least this big are loaded with COPY instead of INSERT on postgres. a batch never holds more than
+# SAVE_BATCH_LIMIT rows, so COPY is only ever used once SAVE_BATCH_LIMIT is raised to at least this value.
+COPY_BATCH_THRESHOLD = int(CONFIG.get("COPY_BATCH_THRESHOLD", 50_000))
+# a consumer commits every GROUP_COMMIT_BATCHES saved batches or GROUP_COMMIT_INTERVAL seconds, whichever comes first
+GROUP_COMMIT_BATCHES = int(CONFIG.get("GROUP_COMMIT_BATCHES", 4))
+GROUP_COMMIT_INTERVAL = float(CONFIG.get("GROUP_COMMIT_INTERVAL", 2.0))
+SAVE_BATCH_MEMORY_WARNING_BYTES = int(CONFIG.get("SAVE_BATCH_MEMORY_WARNING_BYTES", 64 * 1024 * 1024))
 BASE_BLOCK_ATTEMPT = int(CONFIG.get("BLOCK_ATTEMPT1"))
 BLOCK_ATTEMPTS = [
     int(CONFIG.get("BLOCK_ATTEMPT2")),
@@ -1,10 +1,35 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, func, insert
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.orm import scoped_session, sessionmaker
+from src.assignment.config import SAVE_BATCH_LIMIT
 from src.assignment.models import Base
 
 
+def __engine_options(database_uri):
+    # psycopg2 turns an executemany INSERT into multi-row VALUES pages, so size a page to hold a whole save batch
+    if database_uri.startswith("postgresql+psycopg2"):
+        return {"executemany_mode": "values_only", "executemany_values_page_size": SAVE_BATCH_LIMIT}
+    return {}
+
+
 def init_db(database_uri):
-    engine = create_engine(database_uri)
+    engine = create_engine(database_uri, **__engine_options(database_uri))
     session = scoped_session(sessionmaker(bind=engine))
     Base.metadata.create_all(engine)
     return session
+
+
+def insert_ignoring_conflicts(bind, table):
+    """INSERT that skips rows violating a unique constraint, for the dialects we run against."""
+    if bind.dialect.name == "postgresql":
+        return postgresql.insert(table).on_conflict_do_nothing()
+    if bind.dialect.name == "sqlite":
+        return sqlite.insert(table).on_conflict_do_nothing()
+    return insert(table)
+
+
+def timestamp_from_epoch(bind, epoch):
+    """SQL turning epoch seconds into a timestamp, so the database does the conversion instead of python."""
+    if bind.dialect.name == "sqlite":
+        return func.datetime(epoch, "unixepoch")
+    return func.to_timestamp(epoch)
@@ -1,27 +1,59 @@
-import requests
+import aiohttp
+import asyncio
+import csv
+import io
+import orjson
 import typer
 import threading
 import re
-import time
 import queue
+import random
+import sys
+import time
+from collections import deque
+from itertools import islice
+from aiolimiter import AsyncLimiter
+from cachetools import LRUCache
 from datetime import datetime, timezone
+from sqlalchemy import bindparam, select, text
 from sqlalchemy.exc import IntegrityError
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor
 from src.assignment.config import (CONFIG, RECORD_RETRIEVAL_LIMIT, API_KEY, PRODUCER_THREAD_COUNT,
                                    CONSUMER_THREAD_COUNT, DEV_STEP, SEMAPHOR_THREAD_COUNT, SAVE_BATCH_LIMIT,
                                    DEFAULT_ADDRESS, DEV_MODE, DEV_MODE_ENDING_MULTIPLE, DEV_PRODUCER_THREAD_COUNT,
-                                   API_RATE_LIMIT_DELAY, BASE_BLOCK_ATTEMPT, BLOCK_ATTEMPTS, TEST_MODE,
-                                   TEST_MODE_STARTING_BLOCK, TEST_MODE_END_BLOCK)
-from src.assignment.db import init_db
+                                   API_RATE_LIMIT, API_RATE_LIMIT_PERIOD, BASE_BLOCK_ATTEMPT, BLOCK_ATTEMPTS, TEST_MODE,
+                                   TEST_MODE_STARTING_BLOCK, TEST_MODE_END_BLOCK, ETHERSCAN_BATCH_SIZE,
+                                   SAVE_BATCH_MEMORY_WARNING_BYTES, TRANSACTION_QUEUE_SIZE, ADDRESS_CACHE_SIZE,
+                                   HTTP_TIMEOUT, HTTP_KEEPALIVE_TIMEOUT, COPY_BATCH_THRESHOLD,
+                                   GROUP_COMMIT_BATCHES, GROUP_COMMIT_INTERVAL)
+from src.assignment.db import init_db, insert_ignoring_conflicts, timestamp_from_epoch
 from src.assignment.logger import logger
 from src.assignment.models import Address, Transaction
 from src.assignment.config import DATABASE_URI
 
 app = typer.Typer()
 
-api_call_semaphore = threading.Semaphore(SEMAPHOR_THREAD_COUNT)
+etherscan_rate_limiter = AsyncLimiter(max_rate=API_RATE_LIMIT, time_period=API_RATE_LIMIT_PERIOD)
 Session = init_db(DATABASE_URI)
 
+_BLOCK_STEP = DEV_STEP if DEV_MODE else BASE_BLOCK_ATTEMPT
+_PROD_THREADS = DEV_PRODUCER_THREAD_COUNT if DEV_MODE else PRODUCER_THREAD_COUNT
+
+address_id_cache = LRUCache(maxsize=ADDRESS_CACHE_SIZE)
+address_id_cache_lock = threading.Lock()
+
+_HTTP_RETRY_BACKOFF = 0.2
+_QUEUE_PUT_TIMEOUT = 1.0
+
+_DUPLICATE_HASH_RE = re.compile(r'\(hash\)=\(([^)]+)\)')
+_UNIQUE_VIOLATION_PGCODE = "23505"
+
+_TRANSACTION_COPY_COLUMNS = ("block_number", "time_stamp", "hash", "from_address_id", "to_address_id", "value", "gas",
+                             "gas_used", "is_error")
+
+# sqlite before 3.32 allows at most 999 bind parameters in one statement
+_ADDRESS_LOOKUP_CHUNK_SIZE = 900
+
 
 def __log_thread_error(thread_id, current_block, ending_block):
     error_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
@@ -34,8 +66,8 @@ def __log_with_thread_id(message, thread_id):
     logger.info(full_message)
 
 
-def __call_etherscan(address, thread_id=None, startblock=0, endblock=99999999, sort="asc", retries=4,
-                     delay=API_RATE_LIMIT_DELAY):
+async def __call_etherscan(http_session, address, thread_id=None, startblock=0, endblock=99999999, sort="asc",
+                           retries=4):
     api_url = (
         "https://api.etherscan.io/api?module=account&action=txlistinternal&"
         f"address={address}&startblock={startblock}&endblock={endblock}&"
@@ -43,69 +75,185 @@ def __call_etherscan(address, thread_id=None, startblock=0, endblock=99999999, s
     )
 
     for attempt in range(retries):
-        with api_call_semaphore:
-            __log_with_thread_id(
-                f"Calling Etherscan API with current_block: {startblock}, ending_block: {endblock}, thread_id: {thread_id}",
-                thread_id)
-            response = requests.get(api_url)
-            data = response.json()
-            time.sleep(delay)
+        try:
+            async with etherscan_rate_limiter:
+                __log_with_thread_id(
+                    f"Calling Etherscan API with current_block: {startblock}, ending_block: {endblock}, "
+                    f"thread_id: {thread_id}",
+                    thread_id)
+                async with http_session.get(api_url) as response:
+                    data = orjson.loads(await response.read())
+        except (aiohttp.ClientError, asyncio.TimeoutError, orjson.JSONDecodeError) as e:
+            __log_with_thread_id(f"Etherscan request failed on attempt {attempt + 1}: {e}", thread_id)
+            await asyncio.sleep(_HTTP_RETRY_BACKOFF * 2 ** attempt)
+            continue
 
         if data['result'] != 'Max rate limit reached':
             return data
 
     __log_thread_error(thread_id, startblock, endblock)
-    raise Exception("Max rate limit reached after retrying")
+    raise Exception("Max rate limit reached or request failed after retrying")
 
 
-def __get_or_create_address(address):
-    session = Session()
+async def __call_etherscan_batch(http_session, address, block_ranges, thread_id=None):
+    """
+    Fetch several block windows concurrently, results in block_ranges order. The first window to fail cancels the rest.
+    """
     try:
-        addr_obj = session.query(Address).filter_by(address=address).one_or_none()
+        async with asyncio.TaskGroup() as batch_tasks:
+            window_tasks = [
+                batch_tasks.create_task(__call_etherscan(http_session, address, thread_id, startblock=startblock,
+                                                         endblock=endblock))
+                for startblock, endblock in block_ranges
+            ]
+    except ExceptionGroup as e:
+        raise e.exceptions[0]
+    return [window_task.result() for window_task in window_tasks]
+
+
+def __resolve_address_ids(address_connection, addresses):
+    """
+    Map addresses to their row ids, creating the missing ones in a short transaction of their own on
+    address_connection. Every consumer writes the same hot addresses, so holding them until a group commit deadlocks.
+    """
+    unique_addresses = set(addresses)
+    with address_id_cache_lock:
+        address_ids = {address: address_id_cache[address] for address in unique_addresses
+                       if address in address_id_cache}
+
+    # sorted, so concurrent consumers take their row locks in the same order
+    missing_addresses = sorted(address for address in unique_addresses if address not in address_ids)
+    new_address_ids = {}
+    if missing_addresses:
+        with address_connection.begin():
+            if address_connection.dialect.name == "postgresql":
+                # the group commit of the transactions using these addresses flushes the WAL past them anyway
+                address_connection.execute(text("SET LOCAL synchronous_commit = off"))
+            address_connection.execute(insert_ignoring_conflicts(address_connection, Address.__table__),
+                                       [{"address": address} for address in missing_addresses])
+            for chunk_start in range(0, len(missing_addresses), _ADDRESS_LOOKUP_CHUNK_SIZE):
+                chunk = missing_addresses[chunk_start:chunk_start + _ADDRESS_LOOKUP_CHUNK_SIZE]
+                rows = address_connection.execute(
+                    select(Address.id, Address.address).where(Address.address.in_(chunk))
+                )
+                new_address_ids.update({address: address_id for address_id, address in rows})
+        __cache_address_ids(new_address_ids)  # only once committed, a rolled back id must never be cached
+
+    return {**address_ids, **new_address_ids}
+
+
+def __cache_address_ids(address_ids):
+    with address_id_cache_lock:
+        address_id_cache.update(address_ids)
+
+
+def __to_transaction_rows(transactions, address_ids):
+    return [
+        {
+            "block_number": tx["block_number"],
+            "time_stamp_epoch": tx["time_stamp"],
+            "hash": tx["hash"],
+            "from_address_id": address_ids.get(tx["from"]),
+            "to_address_id": address_ids.get(tx["to"]),
+            "value": tx["value"],
+            "gas": tx["gas"],
+            "gas_used": tx["gas_used"],
+            "is_error": tx["is_error"],
+        }
+        for tx in transactions
+    ]
+
+
+def __warn_if_batch_too_large(transactions_to_batch, thread_id):
+    batch_bytes = sys.getsizeof(transactions_to_batch) + sum(map(sys.getsizeof, transactions_to_batch))
+    if batch_bytes > SAVE_BATCH_MEMORY_WARNING_BYTES:
+        logger.warning(f"Consumer_thread_{thread_id} is holding a {batch_bytes} byte batch of "
+                       f"{len(transactions_to_batch)} records, consider lowering SAVE_BATCH_LIMIT")
+
+
+def __copy_transactions(connection, rows):
+    """Load rows with postgres' COPY ... FROM STDIN. Unlike the INSERT there is no ON CONFLICT here."""
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(
+        [datetime.fromtimestamp(row["time_stamp_epoch"], timezone.utc) if column == "time_stamp" else row[column]
+         for column in _TRANSACTION_COPY_COLUMNS]
+        for row in rows
+    )
+    buffer.seek(0)
 
-        if not addr_obj:
-            addr_obj = Address(address=address)
-            session.add(addr_obj)
-            session.commit()
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert(f"COPY {Transaction.__tablename__} ({', '.join(_TRANSACTION_COPY_COLUMNS)}) "
+                           "FROM STDIN WITH (FORMAT CSV)", buffer)
+    finally:
+        cursor.close()
 
-        return addr_obj.id
-    except IntegrityError:
-        session.rollback()
-        addr_obj = session.query(Address).filter_by(address=address).one()
 
-        return addr_obj.id
-    except Exception as e:
-        logger.error(f"An error occurred: {e}")
-        session.rollback()
-        return None
-    finally:
-        session.close()
+def __insert_transactions(connection, rows):
+    statement = insert_ignoring_conflicts(connection, Transaction.__table__).values(
+        time_stamp=timestamp_from_epoch(connection, bindparam("time_stamp_epoch"))
+    )
+    connection.execute(statement, rows)
 
 
-def __save(session, transactions_to_batch, thread_id):
+def __save(connection, address_connection, transactions_to_batch, thread_id):
+    """
+    Write the batch under a savepoint of the open group transaction, see __commit_group. Returns the rows written,
+    0 if the batch failed.
+    """
     try:
         __log_with_thread_id(f"About to save... {len(transactions_to_batch)} records.", "Consumer_thread_" + str(thread_id))
-        session.bulk_save_objects(transactions_to_batch)
-        session.commit()
-        transactions_to_batch.clear()
+        address_ids = __resolve_address_ids(
+            address_connection, [address for tx in transactions_to_batch for address in (tx["from"], tx["to"])]
+        )
+        with connection.begin_nested():
+            rows = __to_transaction_rows(transactions_to_batch, address_ids)
+            __warn_if_batch_too_large(rows, thread_id)
+            if connection.dialect.name == "postgresql" and len(rows) >= COPY_BATCH_THRESHOLD:
+                __copy_transactions(connection, rows)
+            else:
+                __insert_transactions(connection, rows)
+        return len(rows)
     except IntegrityError as e:
-        session.rollback()
-        logger.error(f"Duplicate key error occurred while inserting transactions: {e}")
-        match = re.search(r'\(hash\)=\((.*?)\)', str(e))
+        if getattr(e.orig, "pgcode", None) != _UNIQUE_VIOLATION_PGCODE:
+            logger.error(f"Integrity error occurred while inserting transactions: {e.orig}")
+            return 0
+        logger.error(f"Duplicate key error occurred while inserting transactions: {e.orig}")
+        match = _DUPLICATE_HASH_RE.search(e.orig.diag.message_detail or "")
         if match:
             conflicting_hash = match.group(1)
             logger.error(f"Conflict detected for hash: {conflicting_hash}")
-            conflicting_transactions = [tx for tx in transactions_to_batch if tx.hash == conflicting_hash]
+            conflicting_transactions = [tx for tx in transactions_to_batch if tx["hash"] == conflicting_hash]
             for tx in conflicting_transactions:
-                logger.error(f"Conflicting transaction: {tx.hash}")
-            existing_transaction = session.query(Transaction).filter_by(hash=conflicting_hash).first()
+                logger.error(f"Conflicting transaction: {tx['hash']}")
+            existing_transaction = connection.execute(
+                select(Transaction.__table__).where(Transaction.hash == conflicting_hash)
+            ).first()
             if existing_transaction:
                 logger.error(
                     "Existing transaction in database that caused the conflict: {}".format(existing_transaction))
     except Exception as e:
         __log_with_thread_id(f"An unexpected error occurred while inserting transactions: {e}",
                              "Consumer_thread_" + str(thread_id))
-        session.rollback()
+    return 0
+
+
+def __commit_group(connection, pending_rows, thread_id):
+    """Commit the consumer's open group transaction and start the next one. Returns the rows committed."""
+    try:
+        connection.get_transaction().commit()
+    except Exception as e:
+        __log_with_thread_id(f"Group commit of {pending_rows} rows failed: {e}", "Consumer_thread_" + str(thread_id))
+        if connection.in_transaction():
+            connection.get_transaction().rollback()
+        pending_rows = 0
+    connection.begin()
+    return pending_rows
+
+
+def __is_saturated(data):
+    # should really never be > but just in case...
+    return len(data.get("result", [])) >= RECORD_RETRIEVAL_LIMIT
 
 
 def __block_ranges(start, end, step):
@@ -115,7 +263,47 @@ def __block_ranges(start, end, step):
         current += step
 
 
-def call_api_and_produce(address, starting_block, ending_block, transaction_queue, thread_id):
+def __parse_transactions(results):
+    """Parse the transactions that moved value and didn't error into the types the consumer writes."""
+    return [
+        {
+            "block_number": int(tx["blockNumber"]),
+            "time_stamp": int(tx["timeStamp"]),
+            "hash": tx["hash"],
+            "from": tx["from"],
+            "to": tx["to"],
+            "value": value,
+            "gas": int(tx["gas"]),
+            "gas_used": int(tx["gasUsed"]),
+            "is_error": int(tx["isError"]),
+        }
+        for tx in results
+        if (value := int(tx["value"])) > 0 and tx["isError"] != "1"
+    ]
+
+
+async def __enqueue_transactions(transaction_queues, transactions):
+    # chunked to SAVE_BATCH_LIMIT so TRANSACTION_QUEUE_SIZE still bounds the rows a queue holds
+    shards = [[] for _ in transaction_queues]
+    for tx in transactions:
+        shards[hash(tx["hash"]) % len(transaction_queues)].append(tx)
+
+    for transaction_queue, shard in zip(transaction_queues, shards):
+        for chunk_start in range(0, len(shard), SAVE_BATCH_LIMIT):
+            chunk = shard[chunk_start:chunk_start + SAVE_BATCH_LIMIT]
+            try:
+                transaction_queue.put_nowait(chunk)
+            except queue.Full:
+                # short puts, so a cancelled producer never leaves a thread blocked on a full queue
+                while True:
+                    try:
+                        await asyncio.to_thread(transaction_queue.put, chunk, timeout=_QUEUE_PUT_TIMEOUT)
+                        break
+                    except queue.Full:
+                        continue
+
+
+async def call_api_and_produce(http_session, address, starting_block, ending_block, transaction_queues, thread_id):
     """
     Ingest data into the database from the API.
     - call_api_and_produce from the api using specific startblock and endblock and an offset of 10000
@@ -125,7 +313,7 @@ def call_api_and_produce(address, starting_block, ending_block, transaction_queu
     - if fewer than 10000 records, we batch and save to database
     """
     current_block = starting_block
-    block_window_amount = BASE_BLOCK_ATTEMPT if not DEV_MODE else DEV_STEP
+    block_window_amount = _BLOCK_STEP
     try:
         while current_block <= ending_block:
             __log_with_thread_id(
@@ -133,7 +321,8 @@ def call_api_and_produce(address, starting_block, ending_block, transaction_queu
             )
             tentative_end_block = min(current_block + BASE_BLOCK_ATTEMPT, ending_block)
 
-            data = __call_etherscan(address, thread_id, startblock=current_block, endblock=tentative_end_block)
+            data = await __call_etherscan(http_session, address, thread_id, startblock=current_block,
+                                          endblock=tentative_end_block)
 
             if not data["result"]:
                 __log_with_thread_id(
@@ -144,39 +333,52 @@ def call_api_and_produce(address, starting_block, ending_block, transaction_queu
                 current_block = tentative_end_block + 1
                 continue
 
-            block_attempt_index = 0
+            # (start, end, data, block_attempt_index) in block order
+            fetched_windows = [(current_block, tentative_end_block, data, 0)]
 
-            while len(data.get("result", [])) >= RECORD_RETRIEVAL_LIMIT:  # should really never be > but just in case...
+            while (saturated_index := next((index for index, window in enumerate(fetched_windows)
+                                            if __is_saturated(window[2])), None)) is not None:
+                saturated_start, saturated_end, saturated_data, block_attempt_index = fetched_windows[saturated_index]
                 __log_with_thread_id(
-                    f"Retrieved too many records with {block_window_amount}. "
-                    f"Retrieved {len(data.get("result", []))} records.",
+                    f"Retrieved too many records between blocks {saturated_start} and {saturated_end}. "
+                    f"Retrieved {len(saturated_data.get("result", []))} records.",
                     thread_id
                 )
                 block_window_amount = BLOCK_ATTEMPTS[block_attempt_index] if block_attempt_index < len(
                     BLOCK_ATTEMPTS) else 20
-                tentative_end_block = min(current_block + block_window_amount, ending_block)
+                sub_ranges = list(islice(__block_ranges(saturated_start, saturated_end, block_window_amount + 1),
+                                         max(ETHERSCAN_BATCH_SIZE, 2)))
+                sub_attempt_indexes = [block_attempt_index + 1] * len(sub_ranges)
+                if sub_ranges[-1][1] < saturated_end:
+                    # the last sub window takes the rest, and is split again if it comes back saturated
+                    sub_ranges[-1] = (sub_ranges[-1][0], saturated_end)
+                    sub_attempt_indexes[-1] = block_attempt_index
                 __log_with_thread_id(
-                    f"Adjusting block range to {block_window_amount}, new end block: {tentative_end_block}",
+                    f"Adjusting block range to {block_window_amount}, fetching {len(sub_ranges)} windows between "
+                    f"blocks {saturated_start} and {saturated_end}",
                     thread_id
                 )
-                data = __call_etherscan(address, thread_id, startblock=current_block, endblock=tentative_end_block)
-                block_attempt_index += 1
+                batch = await __call_etherscan_batch(http_session, address, sub_ranges, thread_id)
+                fetched_windows[saturated_index:saturated_index + 1] = [
+                    (sub_start, sub_end, sub_data, sub_attempt_index)
+                    for (sub_start, sub_end), sub_data, sub_attempt_index in zip(sub_ranges, batch,
+                                                                                 sub_attempt_indexes)
+                ]
 
             __log_with_thread_id(
-                f"Etherscan API call SUCCESS! Retrieved {len(data['result'])} records with a block window "
-                f"size of {block_window_amount}",
+                f"Etherscan API call SUCCESS! Retrieved {sum(len(window[2]['result']) for window in fetched_windows)} "
+                f"records across {len(fetched_windows)} block window(s) of size {block_window_amount}",
                 thread_id
             )
 
-            for tx in data["result"]:
-                if int(tx["value"]) > 0 and tx["isError"] != "1":
-                    transaction_queue.put(tx)
+            await __enqueue_transactions(transaction_queues, [
+                tx for _, _, window_data, _ in fetched_windows for tx in __parse_transactions(window_data["result"])
+            ])
 
-            if data["result"]:
-                __log_with_thread_id(f"Changing current block from {current_block}...", thread_id)
-                current_block = tentative_end_block + 1
-                __log_with_thread_id(f"...to new current block {current_block}", thread_id)
-                block_window_amount = BASE_BLOCK_ATTEMPT
+            __log_with_thread_id(f"Changing current block from {current_block}...", thread_id)
+            current_block = fetched_windows[-1][1] + 1
+            __log_with_thread_id(f"...to new current block {current_block}", thread_id)
+            block_window_amount = _BLOCK_STEP
 
     except Exception as e:
         logger.error(f"Failed inside call_api_and_produce data with error: {e}")
@@ -189,38 +391,44 @@ def call_api_and_produce(address, starting_block, ending_block, transaction_queu
 
 def consume(transaction_queue, producers_all_done_event, thread_id):
     __log_with_thread_id("CONSUMER STARTING!", "Consumer_thread_" + str(thread_id))
-    session = Session()
+    connection = Session().get_bind().connect()
+    address_connection = Session().get_bind().connect()
     transactions_to_batch = []
+    rows_committed = 0
+    pending_batches = pending_rows = 0
+    group_deadline = None
 
     try:
+        connection.begin()
         # run until all producers are done and the queue is empty
         while not producers_all_done_event.is_set() or not transaction_queue.empty():
             try:
-                transaction = transaction_queue.get(timeout=5)
-                from_address_id = __get_or_create_address(transaction["from"])
-                to_address_id = __get_or_create_address(transaction["to"])
-
-                transaction = Transaction(
-                    block_number=int(transaction["blockNumber"]),
-                    time_stamp=datetime.fromtimestamp(int(transaction["timeStamp"]), timezone.utc),
-                    hash=transaction["hash"],
-                    from_address_id=from_address_id,
-                    to_address_id=to_address_id,
-                    value=int(transaction["value"]),
-                    gas=int(transaction["gas"]),
-                    gas_used=int(transaction["gasUsed"]),
-                    is_error=int(transaction["isError"]),
-                )
-                transactions_to_batch.append(transaction)
-                if len(transactions_to_batch) >= SAVE_BATCH_LIMIT:
-                    __save(session, transactions_to_batch, thread_id)
-                    transactions_to_batch.clear()
+                get_timeout = 5 if group_deadline is None else min(5, max(group_deadline - time.monotonic(), 0))
+                transactions_to_batch.extend(transaction_queue.get(timeout=get_timeout))
+                while len(transactions_to_batch) >= SAVE_BATCH_LIMIT:
+                    pending_rows += __save(connection, address_connection, transactions_to_batch[:SAVE_BATCH_LIMIT],
+                                           thread_id)
+                    pending_batches += 1
+                    group_deadline = group_deadline or time.monotonic() + GROUP_COMMIT_INTERVAL
+                    del transactions_to_batch[:SAVE_BATCH_LIMIT]
+                    if pending_batches >= GROUP_COMMIT_BATCHES:
+                        rows_committed += __commit_group(connection, pending_rows, thread_id)
+                        pending_batches = pending_rows = 0
+                        group_deadline = None
                     __log_with_thread_id(
                         f"Batch saved. Current transaction queue size: {transaction_queue.qsize()}. "
-                        f"Current db size: {session.query(Transaction).count()}",
+                        f"Rows committed by this consumer: {rows_committed}",
                         "Consumer_thread_" + str(thread_id)
                     )
+                if group_deadline is not None and time.monotonic() >= group_deadline:
+                    rows_committed += __commit_group(connection, pending_rows, thread_id)
+                    pending_batches = pending_rows = 0
+                    group_deadline = None
             except queue.Empty:
+                if pending_batches:
+                    rows_committed += __commit_group(connection, pending_rows, thread_id)
+                    pending_batches = pending_rows = 0
+                    group_deadline = None
                 if producers_all_done_event.is_set():
                     __log_with_thread_id("Producers have finished; no more transactions "
                                          "are expected.", "Consumer_thread_" + str(thread_id)
@@ -232,82 +440,129 @@ def consume(transaction_queue, producers_all_done_event, thread_id):
                 continue
 
         if transactions_to_batch:  # handle any last transactions... say the producers end but the queue is not empty.
-            __save(session, transactions_to_batch, thread_id)
-            __log_with_thread_id(f"Final batch saved. Batch size: {len(transactions_to_batch)}", thread_id)
+            pending_rows += __save(connection, address_connection, transactions_to_batch, thread_id)
+        rows_committed += __commit_group(connection, pending_rows, thread_id)
+        __log_with_thread_id(f"Final batch saved. Batch size: {len(transactions_to_batch)}. "
+                             f"Rows committed by this consumer: {rows_committed}", thread_id)
     except Exception as e:
         __log_with_thread_id(f"Consumer shutting down due to error: {e}", thread_id)
+        raise
     finally:
-        session.close()
-        __log_with_thread_id("Session closed and consumer shutdown.", thread_id)
+        address_connection.close()
+        connection.close()
+        __log_with_thread_id("Connection closed and consumer shutdown.", thread_id)
+
+    return rows_committed
+
+
+def __partition_block_ranges(block_ranges, worker_count):
+    """Split the (thread_id, block_range) pairs into worker_count contiguous deques of near equal length."""
+    numbered_ranges = list(enumerate(block_ranges))
+    run_length, remainder = divmod(len(numbered_ranges), worker_count)
+    work_queues = []
+    run_start = 0
+    for worker_id in range(worker_count):
+        run_end = run_start + run_length + (1 if worker_id < remainder else 0)
+        work_queues.append(deque(numbered_ranges[run_start:run_end]))
+        run_start = run_end
+    return work_queues
+
+
+async def __produce_all(http_session, block_generator, transaction_queues, producer_count):
+    # a worker drains its own deque from the front, then steals from the back of a busy peer's
+    work_queues = __partition_block_ranges(block_generator, producer_count * 4)
+
+    async def produce_worker(worker_id):
+        own_queue = work_queues[worker_id]
+        while True:
+            if own_queue:
+                thread_id, new_range = own_queue.popleft()
+            else:
+                peer_queues = [peer_queue for peer_queue in work_queues if peer_queue]
+                if not peer_queues:
+                    return
+                thread_id, new_range = random.choice(peer_queues).pop()
 
+            try:
+                await call_api_and_produce(http_session, DEFAULT_ADDRESS, *new_range, transaction_queues, thread_id)
+            except Exception as e:
+                # an exception escaping a worker would make the task group cancel all the others
+                logger.error(f"Producer {thread_id} failed with error: {e}")
+
+    async with asyncio.TaskGroup() as producer_tasks:
+        for worker_id in range(len(work_queues)):
+            producer_tasks.create_task(produce_worker(worker_id))
+
+
+async def __ingest():
+    connector = aiohttp.TCPConnector(limit=SEMAPHOR_THREAD_COUNT, keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+                                     ttl_dns_cache=300)
+    timeout = aiohttp.ClientTimeout(total=HTTP_TIMEOUT)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as http_session:
+        data = await __call_etherscan(http_session, DEFAULT_ADDRESS, sort="asc")
+        starting_block = int(data["result"][0]["blockNumber"]) if not TEST_MODE else TEST_MODE_STARTING_BLOCK
+        logger.info(f"Address starting_block: {starting_block}")
+
+        if DEV_MODE:
+            logger.info("IN DEV MODE, CONTRIVED END BLOCK")
+            ending_block = starting_block + DEV_PRODUCER_THREAD_COUNT * DEV_MODE_ENDING_MULTIPLE
+        elif TEST_MODE:
+            logger.info("IN TEST MODE, CONTRIVED END BLOCK")
+            ending_block = int(TEST_MODE_END_BLOCK)
+        else:
+            data = await __call_etherscan(http_session, DEFAULT_ADDRESS, sort="desc")
+            ending_block = int(data["result"][0]["blockNumber"])
+        logger.info(f"Address ending_block: {ending_block}")
+
+        transaction_queues = [queue.Queue(maxsize=TRANSACTION_QUEUE_SIZE) for _ in range(CONSUMER_THREAD_COUNT)]
+        producers_all_done_event = threading.Event()
+
+        block_generator = __block_ranges(starting_block, ending_block, _BLOCK_STEP)
+
+        loop = asyncio.get_running_loop()
+        with ThreadPoolExecutor(max_workers=CONSUMER_THREAD_COUNT) as consumer_executor:
+            consumer_futures = [
+                loop.run_in_executor(consumer_executor, consume, transaction_queues[consumer_thread_id],
+                                     producers_all_done_event, consumer_thread_id)
+                for consumer_thread_id in range(CONSUMER_THREAD_COUNT)
+            ]
+
+            producer_task = asyncio.create_task(__produce_all(http_session, block_generator, transaction_queues,
+                                                              _PROD_THREADS))
+            for consumer_future in consumer_futures:
+                # nothing drains a dead consumer's queue, so don't let the producers wait on it
+                consumer_future.add_done_callback(lambda _: producer_task.cancel())
 
-@app.command()
-def start():
-    logger.info(f"CONFIG: {CONFIG}")
-    data = __call_etherscan(DEFAULT_ADDRESS, sort="asc")
-    starting_block = int(data["result"][0]["blockNumber"]) if not TEST_MODE else TEST_MODE_STARTING_BLOCK
-    logger.info(f"Address starting_block: {starting_block}")
-
-    if DEV_MODE:
-        logger.info("IN DEV MODE, CONTRIVED END BLOCK")
-        ending_block = starting_block + DEV_PRODUCER_THREAD_COUNT * DEV_MODE_ENDING_MULTIPLE
-    elif TEST_MODE:
-        logger.info("IN TEST MODE, CONTRIVED END BLOCK")
-        ending_block = int(TEST_MODE_END_BLOCK)
-    else:
-        data = __call_etherscan(DEFAULT_ADDRESS, sort="desc")
-        ending_block = int(data["result"][0]["blockNumber"])
-    logger.info(f"Address ending_block: {ending_block}")
-
-    queue_for_transactions = queue.Queue()
-    producers_all_done_event = threading.Event()
-    consumer_futures = []
-
-    block_generator = __block_ranges(starting_block, ending_block,
-                                     BASE_BLOCK_ATTEMPT if not DEV_MODE else DEV_STEP)
-
-    with ThreadPoolExecutor(
-            max_workers=PRODUCER_THREAD_COUNT if not DEV_MODE else DEV_PRODUCER_THREAD_COUNT) as executor:
-        futures = []
-        thread_id = 0
-
-        for consumer_thread_id in range(CONSUMER_THREAD_COUNT):
-            consumer_futures.append(
-                executor.submit(consume, queue_for_transactions, producers_all_done_event, consumer_thread_id)
-            )
-
-        for _ in range(PRODUCER_THREAD_COUNT):
             try:
-                new_range = next(block_generator)
-                futures.append(
-                    executor.submit(call_api_and_produce, DEFAULT_ADDRESS, *new_range, queue_for_transactions,
-                                    thread_id)
-                )
-                thread_id += 1
-            except StopIteration:
-                break
-
-        while futures:
-            for future in as_completed(futures):
-                futures.remove(future)
-                try:
-                    new_range = next(block_generator)
-                    futures.append(
-                        executor.submit(call_api_and_produce, DEFAULT_ADDRESS, *new_range, queue_for_transactions,
-                                        thread_id)
-                    )
-                    thread_id += 1
-                except StopIteration:
-                    break
+                await producer_task
+            except asyncio.CancelledError:
+                if asyncio.current_task().cancelling():
+                    raise  # the ingest itself is being cancelled, not just the producers
+            finally:
+                producers_all_done_event.set()
+            logger.info("All producers have finished producing.")
+
+            consumer_results = await asyncio.gather(*consumer_futures, return_exceptions=True)
+            logger.info(f"Consumer has finished processing all items. {consumer_results}")
+            failed_consumers = [result for result in consumer_results if isinstance(result, Exception)]
+            if failed_consumers:
+                raise RuntimeError(f"{len(failed_consumers)} consumer(s) failed, the ingest is incomplete") \
+                    from failed_consumers[0]
+            undrained_queues = [transaction_queue for transaction_queue in transaction_queues
+                                if not transaction_queue.empty()]
+            if producer_task.cancelled() or undrained_queues:
+                raise RuntimeError("A consumer stopped before its queue was drained, the ingest is incomplete")
 
-        producers_all_done_event.set()
-        logger.info("All producers have finished producing.")
+    logger.info("Executor shutdown of consumer and producer complete. Jeff Wan signing off.")
 
-        for consumer_future in consumer_futures:
-            consumer_result = consumer_future.result()  # This ensures that the consumer has processed all items
-        logger.info(f"Consumer has finished processing all items. {consumer_result}")
 
-    logger.info("Executor shutdown of consumer and producer complete. Jeff Wan signing off.")
+@app.command()
+def start():
+    logger.info(f"CONFIG: {CONFIG}")
+    if SAVE_BATCH_LIMIT < COPY_BATCH_THRESHOLD:
+        logger.info(f"SAVE_BATCH_LIMIT ({SAVE_BATCH_LIMIT}) is below COPY_BATCH_THRESHOLD ({COPY_BATCH_THRESHOLD}), "
+                    "every batch is written with INSERT")
+    asyncio.run(__ingest())
 
 
 if __name__ == "__main__":
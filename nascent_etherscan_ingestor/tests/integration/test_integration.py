@@ -21,11 +21,12 @@ class TestIntegrationIngest():
         mocker.patch('src.assignment.ingest.DEFAULT_ADDRESS', new='0xE592427A0AEce92De3Edee1F18E0157C05861564')
         mocker.patch('src.assignment.ingest.DATABASE_URI', new='some_fake_database_uri')
         mocker.patch('src.assignment.ingest.PRODUCER_THREAD_COUNT', new=4)
+        mocker.patch('src.assignment.ingest._PROD_THREADS', new=4)
         mocker.patch('src.assignment.ingest.CONSUMER_THREAD_COUNT', new=1)
         mocker.patch('src.assignment.ingest.SEMAPHOR_THREAD_COUNT', new=4)
-        mocker.patch('src.assignment.ingest.API_RATE_LIMIT_DELAY', new=0.1)
         mocker.patch('src.assignment.ingest.SAVE_BATCH_LIMIT', new=4)
         mocker.patch('src.assignment.ingest.BASE_BLOCK_ATTEMPT', new=8)
+        mocker.patch('src.assignment.ingest._BLOCK_STEP', new=8)
         mocker.patch('src.assignment.ingest.BLOCK_ATTEMPTS', new=[4,2,1])
         mocker.patch('src.assignment.ingest.DEV_MODE', new=None)
         mocker.patch('src.assignment.ingest.DEV_PRODUCER_THREAD_COUNT', new=4)
@@ -1,35 +1,66 @@
+import aiohttp
+import asyncio
+import orjson
 import queue
 import pytest
 import datetime
 import threading
 import time
+from aiolimiter import AsyncLimiter
 from pytest_mock import MockerFixture
-from concurrent.futures import Future
 
-from src.assignment.ingest import start, call_api_and_produce, consume, init_db
-from src.assignment.models import Transaction
+from src.assignment import ingest
+from src.assignment.ingest import start, call_api_and_produce, consume, init_db, address_id_cache
+from src.assignment.models import Address, Transaction
 
 from tests.utils.test_db import init_test_db
 
 SOME_DEFAULT_ADDRESS = 'some_default_address'
+
+
+def etherscan_transaction(**fields):
+    # one internal transaction the way etherscan returns it, every field a string
+    return {"blockNumber": "1", "timeStamp": "101", "hash": "some_hash", "from": "some_from_address",
+            "to": "some_to_address", "value": "1", "contractAddress": "", "input": "", "type": "call", "gas": "400",
+            "gasUsed": "500", "traceId": "0", "isError": "0", "errCode": "", **fields}
+
+
+def build_http_session(mocker, response_function):
+    """
+    Stand-in for an aiohttp.ClientSession. Every get() hands back an async context manager whose response
+    body is whatever response_function returns for that url, serialized to json.
+    """
+    def get(url):
+        response = mocker.MagicMock()
+        response.read = mocker.AsyncMock(return_value=orjson.dumps(response_function(url)))
+        response_context = mocker.MagicMock()
+        response_context.__aenter__.return_value = response
+        return response_context
+
+    http_session = mocker.MagicMock()
+    http_session.get = mocker.Mock(side_effect=get)
+    return http_session
+
+
 @pytest.fixture(autouse=True)
 def mock_config_vars(mocker):
     mocker.patch('src.assignment.ingest.CONFIG', new={})
     mocker.patch("src.assignment.ingest.API_KEY", new="some_api_key")
-    mocker.patch('src.assignment.ingest.API_RATE_LIMIT_DELAY', new=0)
+    mocker.patch('src.assignment.ingest.etherscan_rate_limiter', new=AsyncLimiter(max_rate=1000, time_period=1))
     mocker.patch("src.assignment.ingest.BASE_BLOCK_ATTEMPT", new=4)
+    mocker.patch("src.assignment.ingest._BLOCK_STEP", new=4)
     mocker.patch('src.assignment.ingest.DEFAULT_ADDRESS', new=SOME_DEFAULT_ADDRESS)
     mocker.patch('src.assignment.ingest.DEV_MODE', new=None)
     mocker.patch('src.assignment.ingest.DATABASE_URI', new='some_fake_database_uri')
     mocker.patch("src.assignment.ingest.SAVE_BATCH_LIMIT", new=3)
     mocker.patch('src.assignment.ingest.PRODUCER_THREAD_COUNT', new=4)
+    mocker.patch('src.assignment.ingest._PROD_THREADS', new=4)
     mocker.patch('src.assignment.ingest.CONSUMER_THREAD_COUNT', new=2)
 
 
 @pytest.fixture
 def mock_initial_requests_get_for_block_window(mocker):
-    response_mock_asc = mocker.Mock()
-    response_mock_asc.json.return_value = {
+    response_asc = {
         "status": "1",
         "message": "OK",
         "result": [
@@ -66,8 +97,7 @@ def mock_initial_requests_get_for_block_window(mocker):
         ]
     }
 
-    response_mock_desc = mocker.Mock()
-    response_mock_desc.json.return_value = {
+    response_desc = {
         "status": "1",
         "message": "OK",
         "result": [
@@ -86,14 +116,18 @@ def mock_initial_requests_get_for_block_window(mocker):
         ]
     }
 
-    empty_response = mocker.Mock()
-    empty_response.json.return_value = {
+    empty_response = {
         "status": "1",
         "message": "OK",
         "result": []
     }
 
-    return mocker.patch('src.assignment.ingest.requests.get', side_effect=[response_mock_asc, response_mock_desc, empty_response])
+    responses = iter([response_asc, response_desc, empty_response])
+    http_session = build_http_session(mocker, lambda url: next(responses))
+    client_session = mocker.patch('src.assignment.ingest.aiohttp.ClientSession')
+    client_session.return_value.__aenter__.return_value = http_session
+    mocker.patch('src.assignment.ingest.aiohttp.TCPConnector')
+    return http_session
 
 
 @pytest.fixture
@@ -124,13 +158,12 @@ def mock_etherscan_calls_for_blocks(mocker: MockerFixture):
             ]
         }
 
-    def response_function(url, params=None):
-        response = mocker.Mock()
-        response.json.return_value = create_response(last_block_number[0])
+    def response_function(url):
+        response = create_response(last_block_number[0])
         last_block_number[0] += 2
         return response
 
-    return mocker.patch('src.assignment.ingest.requests.get', side_effect=response_function)
+    return build_http_session(mocker, response_function)
 
 
 @pytest.fixture
@@ -140,14 +173,6 @@ def mock_queue(mocker):
     return mock_queue
 
 
-@pytest.fixture
-def mock_threading_event(mocker):
-    mock_threading_event = mocker.Mock()
-    mocker.patch('src.assignment.ingest.threading.Event', return_value=mock_threading_event)
-
-    return mock_threading_event
-
-
 class TestStart:
     @ pytest.fixture
     def mock_call_api_and_produce(self, mocker):
@@ -155,18 +180,10 @@ class TestStart:
 
     @pytest.fixture
     def mock_consume(self, mocker):
-        return mocker.patch('src.assignment.ingest.consume')
-
-    @pytest.fixture
-    def executor_mock(self, mocker):
-        mock_executor = mocker.patch('src.assignment.ingest.ThreadPoolExecutor', autospec=True)
-        mock_submit = mocker.Mock()
-        # lol this took me forever to figure out how stub out the context manager's return_value
-        mock_executor.return_value.__enter__.return_value.submit = mock_submit
-        future = Future()
-        future.set_result(None)
-        mock_submit.return_value = future
-        return mock_submit
+        # like the real consumer, runs until the producers are done
+        return mocker.patch('src.assignment.ingest.consume',
+                            side_effect=lambda transaction_queue, producers_all_done_event, thread_id:
+                            producers_all_done_event.wait())
 
     def test_correctly_makes_two_api_calls_to_get_block_window(self, mock_initial_requests_get_for_block_window,
                                                                mock_call_api_and_produce, mock_consume):
@@ -175,22 +192,116 @@ class TestStart:
 
         start()
 
-        assert mock_initial_requests_get_for_block_window.call_args_list[0][0][0] == expected_asc_url
-        assert mock_initial_requests_get_for_block_window.call_args_list[1][0][0] == expected_desc_url
-
-    def test_submit_consumer_and_producer_threads_with_proper_args(self, mocker,
-                                                                   mock_initial_requests_get_for_block_window, executor_mock,
-                                                                   mock_call_api_and_produce, mock_queue, mock_threading_event, mock_consume):
-        expected_calls = [
-            mocker.call(mock_consume, mock_queue, mock_threading_event, 0),
-            mocker.call(mock_consume, mock_queue, mock_threading_event, 1),
-            mocker.call(mock_call_api_and_produce, 'some_default_address', 1, 4, mock_queue, 0),
-            mocker.call(mock_call_api_and_produce, 'some_default_address', 5, 8, mock_queue, 1),
+        assert mock_initial_requests_get_for_block_window.get.call_args_list[0][0][0] == expected_asc_url
+        assert mock_initial_requests_get_for_block_window.get.call_args_list[1][0][0] == expected_desc_url
+
+    def test_runs_consumer_threads_and_producer_tasks_with_proper_args(self, mocker,
+                                                                      mock_initial_requests_get_for_block_window,
+                                                                      mock_call_api_and_produce, mock_queue,
+                                                                      mock_consume):
+        http_session = mock_initial_requests_get_for_block_window
+        expected_consumer_calls = [
+            mocker.call(mock_queue, mocker.ANY, 0),
+            mocker.call(mock_queue, mocker.ANY, 1),
         ]
+        expected_producer_calls = [
+            mocker.call(http_session, 'some_default_address', 1, 4, [mock_queue, mock_queue], 0),
+            mocker.call(http_session, 'some_default_address', 5, 8, [mock_queue, mock_queue], 1),
+        ]
+
+        start()
+
+        mock_consume.assert_has_calls(expected_consumer_calls, any_order=True)
+        assert mock_call_api_and_produce.await_args_list == expected_producer_calls
+
+    def test_signals_consumers_once_producers_are_done(self, mock_initial_requests_get_for_block_window,
+                                                       mock_call_api_and_produce, mock_consume):
+        start()
+
+        for consumer_call in mock_consume.call_args_list:
+            _, producers_all_done_event, _ = consumer_call[0]
+            assert producers_all_done_event.is_set()
+
+
+    def test_idle_producers_steal_ranges_so_each_range_is_produced_once(self, mocker,
+                                                                        mock_initial_requests_get_for_block_window,
+                                                                        mock_call_api_and_produce, mock_consume):
+        mocker.patch("src.assignment.ingest.BASE_BLOCK_ATTEMPT", new=1)
+        mocker.patch("src.assignment.ingest._BLOCK_STEP", new=1)
+        mocker.patch('src.assignment.ingest._PROD_THREADS', new=1)
+
+        range_events = []
+
+        async def slow_first_range(http_session, address, starting_block, ending_block, transaction_queues,
+                                   thread_id):
+            range_events.append(("start", starting_block))
+            if starting_block == 1:
+                await asyncio.sleep(0.1)  # the worker that owns blocks 1-2 stalls, a peer should take block 2
+            range_events.append(("finish", starting_block))
+
+        mock_call_api_and_produce.side_effect = slow_first_range
+
+        start()
+
+        # without stealing, block 2 would wait behind block 1 on its owner's deque
+        assert range_events.index(("start", 2)) < range_events.index(("finish", 1))
+        produced_ranges = sorted(call[0][2:4] for call in mock_call_api_and_produce.await_args_list)
+        assert produced_ranges == [(block, block) for block in range(1, 9)]
+        produced_thread_ids = sorted(call[0][5] for call in mock_call_api_and_produce.await_args_list)
+        assert produced_thread_ids == list(range(8))
+
+
+    def test_a_failing_range_does_not_cancel_the_other_producers(self, mocker,
+                                                                 mock_initial_requests_get_for_block_window,
+                                                                 mock_call_api_and_produce, mock_consume):
+        finished_ranges = []
+
+        async def fail_first_range(http_session, address, starting_block, ending_block, transaction_queues,
+                                   thread_id):
+            if starting_block == 1:
+                raise ValueError("etherscan is down")
+            await asyncio.sleep(0.05)  # still running when its sibling fails
+            finished_ranges.append((starting_block, ending_block))
+
+        mock_call_api_and_produce.side_effect = fail_first_range
 
         start()
 
-        executor_mock.assert_has_calls(expected_calls)
+        assert finished_ranges == [(5, 8)]
+
+
+    def test_producers_stop_when_a_consumer_quits_early(self, mocker, mock_initial_requests_get_for_block_window,
+                                                        mock_call_api_and_produce, mock_consume):
+        mocker.patch('src.assignment.ingest.TRANSACTION_QUEUE_SIZE', new=1)
+        mocker.patch('src.assignment.ingest._QUEUE_PUT_TIMEOUT', new=0.05)
+        # the consumer dies straight away, so its queue fills up and is never read again
+        mock_consume.side_effect = lambda transaction_queue, producers_all_done_event, thread_id: None
+        enqueue_transactions = getattr(ingest, '__enqueue_transactions')
+
+        async def flood_queues(http_session, address, starting_block, ending_block, transaction_queues, thread_id):
+            while True:
+                await enqueue_transactions(transaction_queues, [{"hash": "some_hash"}])
+
+        mock_call_api_and_produce.side_effect = flood_queues
+
+        with pytest.raises(RuntimeError, match="A consumer stopped"):
+            start()
+
+    def test_a_consumer_failing_after_the_producers_are_done_fails_the_ingest(self, mocker,
+                                                                              mock_initial_requests_get_for_block_window,
+                                                                              mock_call_api_and_produce, mock_consume):
+        def fail_while_draining(transaction_queue, producers_all_done_event, thread_id):
+            producers_all_done_event.wait()
+            if thread_id == 0:
+                raise ValueError("database went away")
+            return 0
+
+        mock_consume.side_effect = fail_while_draining
+
+        with pytest.raises(RuntimeError, match="1 consumer\\(s\\) failed") as raised:
+            start()
+
+        assert isinstance(raised.value.__cause__, ValueError)
 
 
 class TestCallApiAndProduce:
@@ -238,11 +349,12 @@ class TestCallApiAndProduce:
             f"https://api.etherscan.io/api?module=account&action=txlistinternal&address={SOME_DEFAULT_ADDRESS}&startblock=20&endblock=20&page=1&offset=10000&sort=asc&apikey=some_api_key",
         ]
 
-        call_api_and_produce(SOME_DEFAULT_ADDRESS, starting_block, ending_block, mock_queue, thread_id)
+        asyncio.run(call_api_and_produce(mock_etherscan_calls_for_blocks, SOME_DEFAULT_ADDRESS, starting_block,
+                                         ending_block, [mock_queue], thread_id))
 
-        assert len(mock_etherscan_calls_for_blocks.call_args_list) == len(
-            expected_calls), "Unexpected number of calls to requests.get"
-        for call, expected_url in zip(mock_etherscan_calls_for_blocks.call_args_list, expected_calls):
+        assert len(mock_etherscan_calls_for_blocks.get.call_args_list) == len(
+            expected_calls), "Unexpected number of calls to the etherscan api"
+        for call, expected_url in zip(mock_etherscan_calls_for_blocks.get.call_args_list, expected_calls):
             actual_url = call[0][0]
             assert actual_url == expected_url, f"Expected {expected_url}, got {actual_url}"
 
@@ -263,7 +375,8 @@ class TestCallApiAndProduce:
             {'block_number': 9, 'time_stamp': datetime.datetime(1970, 1, 1, 0, 1, 49, tzinfo=datetime.timezone.utc), 'hash': 'some_hash_9', 'from_address_id': 19, 'to_address_id': 20, 'value': 209, 'gas': 409, 'gas_used': 509, 'is_error': 0}
         ]
 
-        call_api_and_produce(SOME_DEFAULT_ADDRESS, starting_block, ending_block, mock_queue, thread_id)
+        asyncio.run(call_api_and_produce(mock_etherscan_calls_for_blocks, SOME_DEFAULT_ADDRESS, starting_block,
+                                         ending_block, [mock_queue], thread_id))
 
         for call, expected in zip(mock_transaction.call_args_list, expected_transaction_calls):
             _, kwargs = call
@@ -271,7 +384,167 @@ class TestCallApiAndProduce:
             for key, val in expected.items():
                 assert kwargs[key] == val
 
-        assert len(mock_queue.put.call_args_list) == 10 # all the transactions are mocks and the same.
+        assert len(mock_queue.put_nowait.call_args_list) == 5  # one list per fetch
+        assert [tx["value"] for call in mock_queue.put_nowait.call_args_list for tx in call[0][0]] == list(range(200, 210))
+
+    def test_saturated_window_is_split_and_fetched_as_a_batch(self, mocker, mock_queue):
+        mocker.patch('src.assignment.ingest.RECORD_RETRIEVAL_LIMIT', new=2)
+        mocker.patch('src.assignment.ingest.BLOCK_ATTEMPTS', new=[1])
+
+        def response_function(url):
+            tx = etherscan_transaction()
+            # only the first, widest window comes back full
+            return {"status": "1", "message": "OK", "result": [tx, tx] if "startblock=0&endblock=4" in url else [tx]}
+
+        http_session = build_http_session(mocker, response_function)
+        expected_windows = ["startblock=0&endblock=4", "startblock=0&endblock=1", "startblock=2&endblock=3",
+                            "startblock=4&endblock=4"]
+
+        asyncio.run(call_api_and_produce(http_session, SOME_DEFAULT_ADDRESS, 0, 4, [mock_queue], 0))
+
+        actual_urls = [call[0][0] for call in http_session.get.call_args_list]
+        assert len(actual_urls) == len(expected_windows)
+        for actual_url, expected_window in zip(actual_urls, expected_windows):
+            assert expected_window in actual_url
+        assert len(mock_queue.put_nowait.call_args_list) == 1
+        assert len(mock_queue.put_nowait.call_args_list[0][0][0]) == 3
+
+    def test_only_saturated_windows_of_a_batch_are_fetched_again(self, mocker, mock_queue):
+        mocker.patch('src.assignment.ingest.RECORD_RETRIEVAL_LIMIT', new=2)
+        mocker.patch('src.assignment.ingest.BLOCK_ATTEMPTS', new=[1, 0])
+        saturated_windows = ["startblock=0&endblock=4", "startblock=0&endblock=1"]
+
+        def response_function(url):
+            tx = etherscan_transaction()
+            return {"status": "1", "message": "OK",
+                    "result": [tx, tx] if any(window in url for window in saturated_windows) else [tx]}
+
+        http_session = build_http_session(mocker, response_function)
+        expected_windows = ["startblock=0&endblock=4", "startblock=0&endblock=1", "startblock=2&endblock=3",
+                            "startblock=4&endblock=4", "startblock=0&endblock=0", "startblock=1&endblock=1"]
+
+        asyncio.run(call_api_and_produce(http_session, SOME_DEFAULT_ADDRESS, 0, 4, [mock_queue], 0))
+
+        actual_urls = [call[0][0] for call in http_session.get.call_args_list]
+        assert len(actual_urls) == len(expected_windows)
+        for actual_url, expected_window in zip(actual_urls, expected_windows):
+            assert expected_window in actual_url
+        assert sum(len(call[0][0]) for call in mock_queue.put_nowait.call_args_list) == 4
+
+    def test_windows_past_a_full_batch_are_fetched_as_one_remainder(self, mocker, mock_queue):
+        mocker.patch('src.assignment.ingest.RECORD_RETRIEVAL_LIMIT', new=2)
+        mocker.patch('src.assignment.ingest.BLOCK_ATTEMPTS', new=[1])
+        mocker.patch('src.assignment.ingest.ETHERSCAN_BATCH_SIZE', new=2)
+        saturated_windows = ["startblock=0&endblock=4", "startblock=2&endblock=4"]
+
+        def response_function(url):
+            tx = etherscan_transaction()
+            return {"status": "1", "message": "OK",
+                    "result": [tx, tx] if any(window in url for window in saturated_windows) else [tx]}
+
+        http_session = build_http_session(mocker, response_function)
+        expected_windows = ["startblock=0&endblock=4", "startblock=0&endblock=1", "startblock=2&endblock=4",
+                            "startblock=2&endblock=3", "startblock=4&endblock=4"]
+
+        asyncio.run(call_api_and_produce(http_session, SOME_DEFAULT_ADDRESS, 0, 4, [mock_queue], 0))
+
+        actual_urls = [call[0][0] for call in http_session.get.call_args_list]
+        assert len(actual_urls) == len(expected_windows)
+        for actual_url, expected_window in zip(actual_urls, expected_windows):
+            assert expected_window in actual_url
+        assert len(mock_queue.put_nowait.call_args_list[0][0][0]) == 3
+
+    def test_a_failed_window_cancels_the_rest_of_its_batch(self, mocker, mock_queue):
+        mocker.patch('src.assignment.ingest.RECORD_RETRIEVAL_LIMIT', new=2)
+        mocker.patch('src.assignment.ingest.BLOCK_ATTEMPTS', new=[1])
+        cancelled_windows = []
+        tx = etherscan_transaction()
+
+        async def read_response(url):
+            if "startblock=0&endblock=4" in url:
+                return orjson.dumps({"status": "1", "message": "OK", "result": [tx, tx]})
+            if "startblock=0&endblock=1" in url:
+                return orjson.dumps({"status": "0", "message": "NOTOK", "result": "Max rate limit reached"})
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled_windows.append(url)
+                raise
+
+        def get(url):
+            response = mocker.MagicMock()
+            response.read = lambda: read_response(url)
+            response_context = mocker.MagicMock()
+            response_context.__aenter__.return_value = response
+            return response_context
+
+        http_session = mocker.MagicMock()
+        http_session.get = mocker.Mock(side_effect=get)
+
+        async def produce():
+            with pytest.raises(Exception, match="Max rate limit reached"):
+                await call_api_and_produce(http_session, SOME_DEFAULT_ADDRESS, 0, 4, [mock_queue], 0)
+            # checked before asyncio.run tears the loop down, which would cancel any leftovers on its own
+            assert len(cancelled_windows) == 2
+
+        asyncio.run(produce())
+        mock_queue.put_nowait.assert_not_called()
+
+    def test_retries_a_failed_request(self, mocker, mock_queue):
+        mocker.patch('src.assignment.ingest._HTTP_RETRY_BACKOFF', new=0)
+        responses = iter([aiohttp.ClientConnectionError("connection reset"),
+                          {"status": "1", "message": "OK", "result": [etherscan_transaction()]}])
+
+        def response_function(url):
+            response = next(responses)
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+        http_session = build_http_session(mocker, response_function)
+
+        asyncio.run(call_api_and_produce(http_session, SOME_DEFAULT_ADDRESS, 0, 4, [mock_queue], 0))
+
+        assert len(http_session.get.call_args_list) == 2
+        assert len(mock_queue.put_nowait.call_args_list) == 1
+        assert len(mock_queue.put_nowait.call_args_list[0][0][0]) == 1
+
+    def test_transactions_are_sharded_by_hash_across_consumer_queues(self, mock_etherscan_calls_for_blocks):
+        transaction_queues = [queue.Queue(), queue.Queue()]
+
+        asyncio.run(call_api_and_produce(mock_etherscan_calls_for_blocks, SOME_DEFAULT_ADDRESS, 0, 20,
+                                         transaction_queues, 0))
+
+        sharded_transactions = [[tx for shard in transaction_queue.queue for tx in shard]
+                                for transaction_queue in transaction_queues]
+        assert sum(map(len, sharded_transactions)) == 10
+        for index, transactions in enumerate(sharded_transactions):
+            for tx in transactions:
+                assert hash(tx["hash"]) % len(transaction_queues) == index
+
+    def test_each_shard_is_enqueued_in_lists_of_at_most_the_save_limit(self):
+        transaction_queues = [queue.Queue()]
+
+        asyncio.run(getattr(ingest, '__enqueue_transactions')(transaction_queues, [
+            {"hash": f"some_hash_{index}"} for index in range(7)
+        ]))
+
+        assert [len(chunk) for chunk in transaction_queues[0].queue] == [3, 3, 1]
+
+    def test_only_parsed_transactions_that_moved_value_are_enqueued(self, mocker, mock_queue):
+        response = {"status": "1", "message": "OK", "result": [
+            etherscan_transaction(hash="some_hash_1", value="7"),
+            etherscan_transaction(hash="some_hash_2", value="0"),
+            etherscan_transaction(hash="some_hash_3", isError="1"),
+        ]}
+        http_session = build_http_session(mocker, lambda url: response)
+
+        asyncio.run(call_api_and_produce(http_session, SOME_DEFAULT_ADDRESS, 0, 4, [mock_queue], 0))
+
+        mock_queue.put_nowait.assert_called_once_with([{
+            "block_number": 1, "time_stamp": 101, "hash": "some_hash_1", "from": "some_from_address",
+            "to": "some_to_address", "value": 7, "gas": 400, "gas_used": 500, "is_error": 0,
+        }])
 
 
 class TestConsumer():
@@ -279,18 +552,24 @@ class TestConsumer():
     Up until this point we used mocks. Let's use dependencies. I actually think tests using a real test db and test queue are more stable. They are more of a unit test with dependencies and I think that's okay.
     '''
     def create_item(self, index):
+        # what a producer enqueues, already parsed
         return {
-            "blockNumber": index,
-            "timeStamp": 1715350310,
+            "block_number": index,
+            "time_stamp": 1715350310,
             "hash": f'some_hash_{index}',
             "from": f"some_long_hexa_addr_{index}",
             "to": f"some_long_hexa_addr_{index + 1}",
             "value": 100 + index,
             "gas": 200 + index,
-            "gasUsed": 300 + index,
-            "isError": 0
+            "gas_used": 300 + index,
+            "is_error": 0
         }
 
+    @pytest.fixture(autouse=True)
+    def clear_address_id_cache(self):
+        # every test gets a brand new db, so ids cached by an earlier test would be wrong
+        address_id_cache.clear()
+
     @pytest.fixture(autouse=True)
     def test_db(self, mocker):
         test_session = init_db('sqlite:///:memory:')
@@ -302,7 +581,7 @@ class TestConsumer():
         test_queue = queue.Queue()
         queue_length = request.param
         for index in range(queue_length):
-            test_queue.put(self.create_item(index))
+            test_queue.put([self.create_item(index)])
         return test_queue
 
     @pytest.mark.parametrize('mock_consumer_queue', [4], indirect=True)
@@ -315,9 +594,10 @@ class TestConsumer():
 
         assert mock_consumer_queue.qsize() == 4
 
-        consume(mock_consumer_queue, producer_event, 1)
+        rows_committed = consume(mock_consumer_queue, producer_event, 1)
 
         assert mock_consumer_queue.qsize() == 0
+        assert rows_committed == 4
 
     @pytest.mark.parametrize('mock_consumer_queue', [2], indirect=True)
     def test_consumers_consume_all_messages_and_add_transasctions_to_db(self, mocker, mock_consumer_queue, init_test_db):
@@ -331,7 +611,7 @@ class TestConsumer():
         consumer_thread.start()
 
         for i in range(5):
-            mock_consumer_queue.put(self.create_item(i))
+            mock_consumer_queue.put([self.create_item(i)])
 
         time.sleep(0.1)  # Simulate time delay for real-time transaction processing
         producer_event.is_set.return_value = True
@@ -341,3 +621,226 @@ class TestConsumer():
         with session_factory() as sesh:
             transaction_count = sesh.query(Transaction).count()
             assert transaction_count == 7
+
+    @pytest.mark.parametrize('mock_consumer_queue', [4], indirect=True)
+    def test_addresses_shared_across_a_batch_are_created_once(self, mocker, mock_consumer_queue, init_test_db):
+        session_factory = init_test_db
+        mocker.patch('src.assignment.ingest.Session', return_value=session_factory)
+
+        producer_event = mocker.Mock()
+        producer_event.is_set.return_value = True
+
+        consume(mock_consumer_queue, producer_event, 1)
+
+        with session_factory() as sesh:
+            assert sesh.query(Address).count() == 5
+            address = sesh.query(Address).filter_by(address='some_long_hexa_addr_1').one()
+            assert sesh.query(Transaction).filter_by(hash='some_hash_0').one().to_address_id == address.id
+            assert sesh.query(Transaction).filter_by(hash='some_hash_1').one().from_address_id == address.id
+
+    @pytest.mark.parametrize('mock_consumer_queue', [2], indirect=True)
+    def test_resolved_address_ids_are_cached_for_later_batches(self, mocker, mock_consumer_queue, init_test_db):
+        session_factory = init_test_db
+        mocker.patch('src.assignment.ingest.Session', return_value=session_factory)
+
+        producer_event = mocker.Mock()
+        producer_event.is_set.return_value = True
+
+        consume(mock_consumer_queue, producer_event, 1)
+
+        with session_factory() as sesh:
+            for address in sesh.query(Address).all():
+                assert address_id_cache[address.address] == address.id
+        assert len(address_id_cache) == 3
+
+    @pytest.mark.parametrize('mock_consumer_queue', [2], indirect=True)
+    def test_failed_batch_rolls_back_its_transactions_but_keeps_its_addresses(self, mocker, mock_consumer_queue,
+                                                                              init_test_db):
+        session_factory = init_test_db
+        mocker.patch('src.assignment.ingest.Session', return_value=session_factory)
+
+        producer_event = mocker.Mock()
+        producer_event.is_set.return_value = True
+        bad_item = self.create_item(2)
+        del bad_item["gas"]
+        mock_consumer_queue.put([bad_item])
+
+        rows_committed = consume(mock_consumer_queue, producer_event, 1)
+
+        assert rows_committed == 0
+        with session_factory() as sesh:
+            assert sesh.query(Transaction).count() == 0
+            # addresses are committed before the batch is written, so they outlive it and stay cached
+            assert sesh.query(Address).count() == 4
+            for address in sesh.query(Address).all():
+                assert address_id_cache[address.address] == address.id
+
+    @pytest.mark.parametrize('mock_consumer_queue', [4], indirect=True)
+    def test_new_addresses_are_inserted_in_sorted_order(self, mocker, mock_consumer_queue, init_test_db):
+        session_factory = init_test_db
+        mocker.patch('src.assignment.ingest.Session', return_value=session_factory)
+        mocker.patch('src.assignment.ingest.SAVE_BATCH_LIMIT', new=10)
+
+        producer_event = mocker.Mock()
+        producer_event.is_set.return_value = True
+        mock_consumer_queue.queue.reverse()  # the batch lists its addresses in descending order
+
+        consume(mock_consumer_queue, producer_event, 1)
+
+        with session_factory() as sesh:
+            addresses = [address.address for address in sesh.query(Address).order_by(Address.id)]
+            assert addresses == sorted(addresses)
+
+    @pytest.mark.parametrize('mock_consumer_queue', [4], indirect=True)
+    def test_copy_is_only_used_on_postgres(self, mocker, mock_consumer_queue, init_test_db):
+        session_factory = init_test_db
+        mocker.patch('src.assignment.ingest.Session', return_value=session_factory)
+        mocker.patch('src.assignment.ingest.COPY_BATCH_THRESHOLD', new=1)
+
+        producer_event = mocker.Mock()
+        producer_event.is_set.return_value = True
+
+        consume(mock_consumer_queue, producer_event, 1)
+
+        with session_factory() as sesh:
+            assert sesh.query(Transaction).count() == 4
+
+    @pytest.mark.parametrize('mock_consumer_queue', [0], indirect=True)
+    def test_failed_batch_only_rolls_back_itself_within_a_commit_group(self, mocker, mock_consumer_queue, tmp_path):
+        # a file database, so consume's connection and address connection really are two connections
+        session_factory = init_db(f"sqlite:///{tmp_path / 'ingest.db'}")
+        mocker.patch('src.assignment.ingest.Session', new=session_factory)
+        mocker.patch('src.assignment.ingest.SAVE_BATCH_LIMIT', new=1)
+        mocker.patch('src.assignment.ingest.GROUP_COMMIT_BATCHES', new=3)
+        mocker.patch('src.assignment.ingest.GROUP_COMMIT_INTERVAL', new=60)
+        insert_transactions = getattr(ingest, '__insert_transactions')
+
+        def insert_then_fail(connection, rows):
+            insert_transactions(connection, rows)
+            if rows[0]["hash"] == "some_hash_1":
+                raise RuntimeError("failed after its rows were written")
+
+        mocker.patch('src.assignment.ingest.__insert_transactions', side_effect=insert_then_fail)
+
+        producer_event = mocker.Mock()
+        producer_event.is_set.return_value = True
+        for index in range(3):
+            item = self.create_item(index)
+            # sqlite has one writer at a time, so no later batch adds addresses while the group is open
+            item["from"], item["to"] = "some_long_hexa_addr_0", "some_long_hexa_addr_1"
+            mock_consumer_queue.put([item])
+
+        rows_committed = consume(mock_consumer_queue, producer_event, 1)
+
+        assert rows_committed == 2
+        with session_factory() as sesh:
+            assert sorted(tx.hash for tx in sesh.query(Transaction)) == ['some_hash_0', 'some_hash_2']
+
+    @pytest.mark.parametrize('mock_consumer_queue', [1], indirect=True)
+    def test_a_group_is_committed_once_its_interval_passes_even_while_the_queue_is_idle(self, mocker,
+                                                                                        mock_consumer_queue,
+                                                                                        init_test_db):
+        session_factory = init_test_db
+        mocker.patch('src.assignment.ingest.Session', return_value=session_factory)
+        mocker.patch('src.assignment.ingest.SAVE_BATCH_LIMIT', new=1)
+        mocker.patch('src.assignment.ingest.GROUP_COMMIT_BATCHES', new=100)
+        mocker.patch('src.assignment.ingest.GROUP_COMMIT_INTERVAL', new=0.05)
+        commit_group = mocker.patch('src.assignment.ingest.__commit_group',
+                                    wraps=getattr(ingest, '__commit_group'))
+
+        producer_event = mocker.Mock()
+        producer_event.is_set.return_value = False
+
+        consumer_thread = threading.Thread(target=consume, args=(mock_consumer_queue, producer_event, 1))
+        consumer_thread.start()
+        time.sleep(0.5)  # well past the interval, well short of the consumer's 5 second get timeout
+        commits_while_idle = [call[0][1] for call in commit_group.call_args_list]
+        producer_event.is_set.return_value = True
+        consumer_thread.join()
+
+        assert commits_while_idle == [1]
+
+    @pytest.mark.parametrize('mock_consumer_queue', [1], indirect=True)
+    def test_an_error_outside_a_batch_is_raised_to_the_caller(self, mocker, mock_consumer_queue, init_test_db):
+        session_factory = init_test_db
+        mocker.patch('src.assignment.ingest.Session', return_value=session_factory)
+        mocker.patch('src.assignment.ingest.__save', side_effect=OSError("disk full"))
+
+        producer_event = mocker.Mock()
+        producer_event.is_set.return_value = True
+
+        with pytest.raises(OSError, match="disk full"):
+            consume(mock_consumer_queue, producer_event, 1)
+
+    @pytest.mark.parametrize('mock_consumer_queue', [0], indirect=True)
+    def test_a_large_list_is_saved_in_batches_of_the_save_limit(self, mocker, mock_consumer_queue, init_test_db):
+        session_factory = init_test_db
+        mocker.patch('src.assignment.ingest.Session', return_value=session_factory)
+        save = mocker.patch('src.assignment.ingest.__save', side_effect=lambda connection, address_connection, batch, thread_id: len(batch))
+
+        producer_event = mocker.Mock()
+        producer_event.is_set.return_value = True
+        mock_consumer_queue.put([self.create_item(index) for index in range(7)])
+
+        rows_committed = consume(mock_consumer_queue, producer_event, 1)
+
+        assert [len(call[0][2]) for call in save.call_args_list] == [3, 3, 1]
+        assert rows_committed == 7
+
+    @pytest.mark.parametrize('mock_consumer_queue', [1], indirect=True)
+    def test_epoch_timestamps_are_converted_by_the_database(self, mocker, mock_consumer_queue, init_test_db):
+        session_factory = init_test_db
+        mocker.patch('src.assignment.ingest.Session', return_value=session_factory)
+
+        producer_event = mocker.Mock()
+        producer_event.is_set.return_value = True
+
+        consume(mock_consumer_queue, producer_event, 1)
+
+        with session_factory() as sesh:
+            time_stamp = sesh.query(Transaction).one().time_stamp
+            assert time_stamp.replace(tzinfo=None) == datetime.datetime(2024, 5, 10, 14, 11, 50)
+
+    @pytest.mark.parametrize('mock_consumer_queue', [0], indirect=True)
+    def test_internal_transactions_sharing_a_hash_are_all_saved(self, mocker, mock_consumer_queue, init_test_db):
+        session_factory = init_test_db
+        mocker.patch('src.assignment.ingest.Session', return_value=session_factory)
+
+        producer_event = mocker.Mock()
+        producer_event.is_set.return_value = True
+        # two internal calls of one parent transaction, see docs/notes_api.md
+        first_call, second_call = self.create_item(0), self.create_item(1)
+        second_call["hash"] = first_call["hash"]
+        mock_consumer_queue.put([first_call, second_call])
+
+        rows_committed = consume(mock_consumer_queue, producer_event, 1)
+
+        assert rows_committed == 2
+        with session_factory() as sesh:
+            assert sesh.query(Transaction).filter_by(hash=first_call["hash"]).count() == 2
+
+
+class TestCopyTransactions:
+    def test_writes_rows_as_csv_in_copy_column_order(self, mocker):
+        copied = {}
+        cursor = mocker.Mock()
+        cursor.copy_expert.side_effect = lambda sql, buffer: copied.update(sql=sql, csv=buffer.read())
+        connection = mocker.Mock()
+        connection.connection.cursor.return_value = cursor
+        rows = [
+            {"block_number": 1, "time_stamp_epoch": 1715350310, "hash": "some_hash_1", "from_address_id": 1,
+             "to_address_id": 2, "value": 10 ** 20, "gas": 400, "gas_used": 500, "is_error": 0},
+            {"block_number": 2, "time_stamp_epoch": 101, "hash": "some_hash_2", "from_address_id": 3,
+             "to_address_id": None, "value": 7, "gas": 401, "gas_used": 501, "is_error": 0},
+        ]
+
+        getattr(ingest, '__copy_transactions')(connection, rows)
+
+        assert copied["sql"] == ("COPY transactions (block_number, time_stamp, hash, from_address_id, to_address_id, "
+                                 "value, gas, gas_used, is_error) FROM STDIN WITH (FORMAT CSV)")
+        # an empty unquoted field is NULL to COPY's CSV format
+        assert copied["csv"].splitlines() == [
+            "1,2024-05-10 14:11:50+00:00,some_hash_1,1,2,100000000000000000000,400,500,0",
+            "2,1970-01-01 00:01:41+00:00,some_hash_2,3,,7,401,501,0",
+        ]
+        cursor.close.assert_called_once()